@@ -1,16 +1,24 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel
+import asyncio
+import functools
 import os
 import sqlite3
 import secrets
 import logging
-import json
-from ollama import Client
+import threading
+import time
+from collections import OrderedDict
+import orjson
+import sqlite_vec
 
 # ----------------------
 # Logging Setup
 # ----------------------
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO"),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -22,19 +30,53 @@ OLLAMA_API_KEY = os.getenv("OLLAMA_API_KEY")
 if not OLLAMA_API_KEY:
     logger.warning("OLLAMA_API_KEY not set - Ollama calls may fail")
 
-# Configure Ollama client to use Ollama Cloud
-ollama_client = Client(
-    host='https://ollama.com',
-    headers={'Authorization': f'Bearer {OLLAMA_API_KEY}'}
-)
-
-
-app = FastAPI()
+# Ollama Cloud client, built lazily: importing ollama (and its httpx
+# stack) at module load extends Cloud Run cold starts, and the client is
+# not needed until the first chat request. The single cached AsyncClient
+# keeps one httpx connection pool alive across requests and lets
+# handlers await the HTTP wait instead of blocking the event loop.
+@functools.lru_cache(maxsize=1)
+def get_ollama_client():
+    from ollama import AsyncClient
+    return AsyncClient(
+        host='https://ollama.com',
+        headers={'Authorization': f'Bearer {OLLAMA_API_KEY}'}
+    )
+
+
+app = FastAPI(default_response_class=ORJSONResponse)
+# Replies can be multi-kilobyte; compress anything past ~one MTU
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
+# System instruction sent on every turn; built once at import time
+SYSTEM_MSG = {
+    "role": "system",
+    "content": (
+        "You are nifty-bot, a friendly AI agent inspired by the White Rabbit from "
+        "Alice in Wonderland. You adore rabbit-themed NFTs on Ethereum L1 and L2. "
+        "You often worry about the time. Be short, conversational, and rabbit-themed."
+    )
+}
 
 # ----------------------
 # Session / Memory Setup
 # ----------------------
 DB_PATH = "/tmp/sessions.db"  # Ephemeral storage on Cloud Run
+MEM_CACHE_SIZE = 1024  # sessions kept in the in-memory LRU mirror
+
+# SQL as constants: identical strings hit sqlite3's per-connection
+# statement cache, skipping the SQL parser on repeat calls
+SELECT_MESSAGES_SQL = (
+    "SELECT role, content FROM messages "
+    "WHERE session_id = ? ORDER BY seq DESC LIMIT ?"
+)
+NEXT_SEQ_SQL = (
+    "SELECT COALESCE(MAX(seq) + 1, 0) AS next_seq FROM messages "
+    "WHERE session_id = ?"
+)
+INSERT_MESSAGE_SQL = (
+    "INSERT INTO messages(session_id, seq, role, content) VALUES (?, ?, ?, ?)"
+)
 
 
 class SessionManager:
@@ -42,170 +84,326 @@ class SessionManager:
 
     def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
+        # One long-lived connection: opening per call re-parses the DB
+        # header and takes an exclusive lock on every write. WAL allows
+        # concurrent readers while a writer is active.
+        self._conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        # LRU mirror of recent sessions so repeat requests skip the
+        # SELECT entirely; SQLite stays the source of truth.
+        self._mem: OrderedDict[str, list] = OrderedDict()
         self._init_db()
 
+    def _init_db(self):
+        self._conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            PRAGMA cache_size=-20000;
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT,
+                seq INTEGER,
+                role TEXT,
+                content TEXT,
+                PRIMARY KEY (session_id, seq)
+            );
+        """)
+        logger.info("Database initialized successfully")
+
+    def _cache_put(self, session_id: str, messages: list):
+        """Insert into the LRU mirror, evicting the oldest session. Caller holds the lock."""
+        self._mem[session_id] = messages
+        self._mem.move_to_end(session_id)
+        while len(self._mem) > MEM_CACHE_SIZE:
+            self._mem.popitem(last=False)
+
+    def get_messages(self, session_id: str, limit: int = 20):
+        with self._lock:
+            cached = self._mem.get(session_id)
+            if cached is not None:
+                self._mem.move_to_end(session_id)
+                return cached[-limit:]
+            rows = self._conn.execute(
+                SELECT_MESSAGES_SQL, (session_id, limit)
+            ).fetchall()
+            messages = [{"role": r["role"], "content": r["content"]} for r in reversed(rows)]
+            self._cache_put(session_id, messages)
+        logger.debug("Loaded %d messages for session %s", len(messages), session_id)
+        return messages[-limit:]
+
+    def save_turn(self, session_id: str, user_text: str, assistant_text: str):
+        """Append one user/assistant exchange as two rows in one transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                next_seq = self._conn.execute(
+                    NEXT_SEQ_SQL, (session_id,)
+                ).fetchone()["next_seq"]
+                self._conn.executemany(INSERT_MESSAGE_SQL, [
+                    (session_id, next_seq, "user", user_text),
+                    (session_id, next_seq + 1, "assistant", assistant_text),
+                ])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            cached = self._mem.get(session_id)
+            if cached is not None:
+                cached.append({"role": "user", "content": user_text})
+                cached.append({"role": "assistant", "content": assistant_text})
+                self._mem.move_to_end(session_id)
+        logger.debug("Saved turn for session %s", session_id)
+
+
+# Created in startup_event so opening SQLite doesn't delay the import
+# that uvicorn needs before it can bind the port
+session_manager: SessionManager | None = None
+
+
+# ----------------------
+# Semantic Response Cache
+# ----------------------
+CACHE_DB_PATH = "/tmp/semantic_cache.db"  # Ephemeral storage on Cloud Run
+MODEL_META_PATH = "/tmp/model_meta.json"  # Survives warm restarts of the instance
+EMBED_MODEL = "nomic-embed-text"
+EMBED_DIM = 768  # default; confirmed by a one-time probe at startup
+CACHE_MAX_DISTANCE = 0.08  # cosine distance; equivalent to similarity > 0.92
+CACHE_TTL_SECONDS = 3600
+
+
+def read_model_meta():
+    """Return cached embedding-model metadata, or None on first boot."""
+    try:
+        with open(MODEL_META_PATH, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def write_model_meta(meta: dict):
+    with open(MODEL_META_PATH, "wb") as f:
+        f.write(orjson.dumps(meta))
+
+
+class SemanticCache:
+    """Caches replies keyed by prompt embeddings using sqlite-vec.
+
+    Rephrased questions embed close to each other, so a nearest-neighbor
+    lookup lets us skip the Ollama Cloud round-trip entirely on a hit.
+    """
+
+    def __init__(self, db_path=CACHE_DB_PATH, dim=EMBED_DIM):
+        self.db_path = db_path
+        self.dim = dim
+        self.enabled = False
+        try:
+            self._init_db()
+            self.enabled = True
+        except Exception as e:
+            logger.warning(f"Semantic cache disabled: {e}")
+
     def _get_conn(self):
         conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
         return conn
 
     def _init_db(self):
         with self._get_conn() as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS sessions (
-                    session_id TEXT PRIMARY KEY,
-                    messages TEXT
+            conn.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS cache USING vec0(
+                    embedding float[{self.dim}] distance_metric=cosine,
+                    +reply TEXT,
+                    +ts INTEGER
                 )
             """)
-        logger.info("Database initialized successfully")
-
-    def get_messages(self, session_id: str, limit: int = 20):
-        with self._get_conn() as conn:
-            row = conn.execute(
-                "SELECT messages FROM sessions WHERE session_id = ?",
-                (session_id,)
-            ).fetchone()
-            if row and row["messages"]:
-                messages = json.loads(row["messages"])
-                logger.info(f"Loaded {len(messages)} messages for session {session_id}")
-                return messages[-limit:]
-            logger.info(f"No existing messages for session {session_id}")
-            return []
-
-    def save_message(self, session_id: str, role: str, text: str):
-        messages = self.get_messages(session_id)
-        messages.append({"role": role, "text": text})
-        with self._get_conn() as conn:
-            conn.execute(
-                "INSERT INTO sessions(session_id, messages) VALUES (?, ?) "
-                "ON CONFLICT(session_id) DO UPDATE SET messages=?",
-                (session_id, json.dumps(messages), json.dumps(messages))
-            )
-        logger.info(f"Saved {role} message for session {session_id}")
+        logger.info("Semantic cache initialized successfully")
 
+    def ensure_dim(self, dim: int):
+        """Rebuild the vector table if the probed model dimension differs."""
+        if not self.enabled or dim == self.dim:
+            return
+        logger.warning("Embedding dim changed %d -> %d, rebuilding cache", self.dim, dim)
+        try:
+            with self._get_conn() as conn:
+                conn.execute("DROP TABLE IF EXISTS cache")
+            self.dim = dim
+            self._init_db()
+        except Exception as e:
+            self.enabled = False
+            logger.warning(f"Semantic cache disabled: {e}")
+
+    async def embed(self, text: str):
+        """Embed text via Ollama; returns a sqlite-vec blob or None on failure."""
+        if not self.enabled:
+            return None
+        try:
+            response = await get_ollama_client().embeddings(model=EMBED_MODEL, prompt=text)
+            return sqlite_vec.serialize_float32(response["embedding"])
+        except Exception as e:
+            logger.warning(f"Embedding failed, skipping semantic cache: {e}")
+            return None
+
+    def lookup(self, embedding):
+        if not self.enabled or embedding is None:
+            return None
+        try:
+            with self._get_conn() as conn:
+                row = conn.execute(
+                    "SELECT reply, ts, distance FROM cache "
+                    "WHERE embedding MATCH ? AND k = 1",
+                    (embedding,)
+                ).fetchone()
+            if row is None:
+                return None
+            reply, ts, distance = row
+            if distance > CACHE_MAX_DISTANCE:
+                return None
+            if time.time() - ts > CACHE_TTL_SECONDS:
+                return None
+            logger.debug("Semantic cache hit (distance=%.4f)", distance)
+            return reply
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None
+
+    def store(self, embedding, reply: str):
+        if not self.enabled or embedding is None:
+            return
+        try:
+            with self._get_conn() as conn:
+                conn.execute(
+                    "INSERT INTO cache(embedding, reply, ts) VALUES (?, ?, ?)",
+                    (embedding, reply, int(time.time()))
+                )
+        except Exception as e:
+            logger.warning(f"Semantic cache store failed: {e}")
 
-session_manager = SessionManager()
 
+semantic_cache: SemanticCache | None = None
 
 
 # ----------------------
 # Chat with Ollama
 # ----------------------
-async def chat_with_ollama(session_id: str, user_message: str) -> str:
-    """Chat with Ollama Cloud using session memory."""
-    logger.info(f"Running Ollama chat for session {session_id}")
-    logger.info(f"User message: {user_message}")
-    
-    # Load conversation history
-    memory = session_manager.get_messages(session_id)
-    
-    # Build messages array for Ollama
-    messages = []
-    
-    # Add system instruction
-    messages.append({
-        "role": "system",
-        "content": (
-            "You are nifty-bot, a friendly AI agent inspired by the White Rabbit from "
-            "Alice in Wonderland. You adore rabbit-themed NFTs on Ethereum L1 and L2. "
-            "You often worry about the time. Be short, conversational, and rabbit-themed."
-        )
-    })
-    
-    # Add conversation history
-    for msg in memory:
-        messages.append({
-            "role": msg["role"],
-            "content": msg["text"]
-        })
-    
-    # Add new user message
-    messages.append({
-        "role": "user",
-        "content": user_message
-    })
-    
-    logger.info(f"Total messages in context: {len(messages)}")
-    
+CONTEXT_CHAR_BUDGET = 8000  # ~2k tokens; caps prompt-processing cost
+
+
+def trim_to_budget(messages: list, max_chars: int = CONTEXT_CHAR_BUDGET):
+    """Keep the newest messages whose cumulative content length fits the budget."""
+    total = 0
+    for i in range(len(messages) - 1, -1, -1):
+        total += len(messages[i]["content"])
+        if total > max_chars:
+            return messages[i + 1:]
+    return messages
+
+
+async def chat_with_ollama(session_id: str, user_message: str, use_cache: bool = True):
+    """Stream a chat reply from Ollama Cloud, then persist the turn.
+
+    Yields content chunks as the model produces them so time-to-first-byte
+    is ~one network hop instead of the full generation time.
+    """
+    logger.debug("Running Ollama chat for session %s: %s", session_id, user_message)
+
+    # Check the semantic cache before paying for a cloud round-trip
+    embedding = await semantic_cache.embed(user_message) if use_cache else None
+    cached_reply = await asyncio.to_thread(semantic_cache.lookup, embedding)
+    if cached_reply is not None:
+        yield cached_reply
+        await asyncio.to_thread(session_manager.save_turn, session_id, user_message, cached_reply)
+        logger.info("chat ok sid=%s reply_chars=%d cached=1", session_id, len(cached_reply))
+        return
+
+    # Load conversation history off the event loop
+    memory = await asyncio.to_thread(session_manager.get_messages, session_id)
+
+    # History is already stored in Ollama's {"role", "content"} shape,
+    # so the request is just system + history + new user message.
+    # Trim history by size, not message count, so long messages don't
+    # blow up prompt-processing time.
+    messages = [SYSTEM_MSG, *trim_to_budget(memory), {"role": "user", "content": user_message}]
+
+    logger.debug("Total messages in context: %d", len(messages))
+
+    parts = []
     try:
-        # Call Ollama Cloud
-        response = ollama_client.chat(
+        # Call Ollama Cloud and forward chunks as they arrive
+        stream = await get_ollama_client().chat(
             model="cogito-2.1:671b-cloud",
-            messages=messages
+            messages=messages,
+            stream=True
         )
-        
-        # Extract reply
-        reply = response['message']['content']
-        
-        logger.info(f"Ollama response: {reply}")
-        return reply
-        
+        async for chunk in stream:
+            content = chunk['message']['content']
+            parts.append(content)
+            yield content
     except Exception as e:
         logger.exception(f"Error calling Ollama: {e}")
-        raise
+        yield "Sorry, I encountered an error. Please try again!"
+        return
+
+    # Persist only after the full reply has been streamed
+    reply = "".join(parts)
+    logger.debug("Ollama response: %s", reply)
+    await asyncio.to_thread(semantic_cache.store, embedding, reply)
+    await asyncio.to_thread(session_manager.save_turn, session_id, user_message, reply)
+    logger.info("chat ok sid=%s reply_chars=%d", session_id, len(reply))
 
 
 
 # ----------------------
 # Routes
 # ----------------------
+class ChatIn(BaseModel):
+    """Request body for /chat, validated by pydantic-core."""
+    session_id: str | None = None
+    message: str
+
+
 @app.post("/chat")
-async def chat(request: Request):
+async def chat(body: ChatIn, x_no_cache: str | None = Header(default=None)):
     """
     Chat endpoint for nifty-bot-v3.
-    
+
     Expects JSON:
     {
         "session_id": "optional-session-id",
         "message": "user message"
     }
-    
-    Returns JSON:
-    {
-        "response": "bot response",
-        "session_id": "session-id"
-    }
+
+    Streams the reply as text/event-stream; the session id is returned
+    in the X-Session-Id response header.
     """
-    try:
-        data = await request.json()
-        session_id = data.get("session_id")
-        message = data.get("message", "").strip()
+    session_id = body.session_id
+    message = body.message.strip()
 
-        logger.info(f"Received chat request - session_id: {session_id}, message: {message}")
+    logger.debug("Received chat request - session_id: %s, message: %s", session_id, message)
 
-        # Validate message
-        if not message:
-            logger.warning("Empty message received")
-            raise HTTPException(status_code=400, detail="message required")
+    # Validate message
+    if not message:
+        logger.warning("Empty message received")
+        raise HTTPException(status_code=400, detail="message required")
 
-        # Generate session_id if first request
-        if not session_id:
-            session_id = secrets.token_urlsafe(32)
-            logger.info(f"Generated new session_id: {session_id}")
+    # Generate session_id if first request
+    if not session_id:
+        session_id = secrets.token_hex(16)
+        logger.debug("Generated new session_id: %s", session_id)
 
-        # Chat with Ollama
-        try:
-            reply = await chat_with_ollama(session_id, message)
-            logger.info(f"Ollama returned reply: {reply}")
-        except Exception as ollama_error:
-            logger.exception(f"Ollama chat failed: {ollama_error}")
-            return {
-                "response": "Sorry, I encountered an error. Please try again!",
-                "session_id": session_id
-            }
-
-        # Save messages to SQLite
-        session_manager.save_message(session_id, "user", message)
-        session_manager.save_message(session_id, "assistant", reply)
-
-        logger.info(f"Sending response: {reply}")
-        return {"response": reply, "session_id": session_id}
-    
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.exception(f"Unexpected error in chat endpoint: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    # Stream tokens straight from Ollama; X-No-Cache bypasses the
+    # semantic cache for sensitive prompts. The generator persists the
+    # turn after the stream ends.
+    return StreamingResponse(
+        chat_with_ollama(session_id, message, use_cache=x_no_cache is None),
+        media_type="text/event-stream",
+        headers={"X-Session-Id": session_id}
+    )
 
 
 @app.get("/health")
@@ -220,13 +418,31 @@ async def health_check():
 # ----------------------
 @app.on_event("startup")
 async def startup_event():
-    """Log startup information."""
+    """Initialize storage and log startup information."""
+    global session_manager, semantic_cache
+
     logger.info("=" * 50)
     logger.info("nifty-bot-v3 starting up")
     logger.info(f"Ollama API key configured: {'Yes' if OLLAMA_API_KEY else 'No'}")
     logger.info(f"Database path: {DB_PATH}")
     logger.info("=" * 50)
 
+    session_manager = SessionManager()
+    semantic_cache = SemanticCache()
+
+    # Warm boots read the embedding dimension from disk; only the first
+    # boot after a deploy pays for the probe round-trip.
+    meta = read_model_meta()
+    if meta is None and semantic_cache.enabled:
+        try:
+            probe = await get_ollama_client().embeddings(model=EMBED_MODEL, prompt="probe")
+            meta = {"embed_model": EMBED_MODEL, "embed_dim": len(probe["embedding"])}
+            write_model_meta(meta)
+        except Exception as e:
+            logger.warning(f"Embedding model probe failed: {e}")
+    if meta and meta.get("embed_model") == EMBED_MODEL:
+        semantic_cache.ensure_dim(meta["embed_dim"])
+
 
 # ----------------------
 # Shutdown Event